@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import hashlib
 import json
 import os
 import re
@@ -14,6 +15,7 @@ from datetime import datetime
 import ffmpeg
 import requests
 import tqdm
+from requests.adapters import HTTPAdapter
 
 CLIENT_ID = 'ue6666qo983tsx6so1t0vnawi233wa'
 API_BASE = 'https://api.twitch.tv'
@@ -24,10 +26,54 @@ GQL_URL = 'https://gql.twitch.tv/gql'
 DEFAULT_MAX_WORKERS = 16
 SEGMENT_DOWNLOAD_TIMEOUT = 30  # seconds
 SEGMENT_DOWNLOAD_RETRIES = 3
+# Segments are already-compressed video; asking for gzip only burns CPU on both ends.
+SEGMENT_HEADERS = {'Accept-Encoding': 'identity'}
+COPY_BUFFER_SIZE = 1 << 20  # bytes per read/write when streaming a segment to disk
+PROGRESS_UPDATE_EVERY = 50  # segments per progress bar update
+ARIA2_MAX_CONCURRENT = 64  # parallel segment downloads when aria2c is available
+ARIA2_MAX_CONNECTIONS_PER_SERVER = 16
+
+# Single pass over the media playlist, one match per line: key lines, other tags/comments
+# (an empty "comment" is a blank line, kept so the rewrite stays line-faithful), and segment URIs.
+_LINE_RE = re.compile(r'^[ \t]*(?:#EXT-X-KEY:(?P<key>.*)|(?P<comment>#.*|)|(?P<seg>[^#\s].*))\r?$', re.M)
+# EXT-X-KEY attributes like METHOD=AES-128,URI="https://...",IV=0x...
+_KEY_ATTR_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]+)')
+# Relative URIs urljoin would rewrite rather than append: control chars/spaces (stripped
+# or removed by urlsplit), a scheme, query or fragment, an empty or dot path segment,
+# or a leading '/' or '.'.
+_NEEDS_URLJOIN_RE = re.compile(r'[\x00-\x20:?#]|//|/\.|^[/.]')
+# Tags that only describe the playlist or its timing; a playlist using nothing else
+# (besides unencrypted .ts URIs) can be muxed by concatenating whole segment files.
+_CONCAT_SAFE_TAGS = frozenset({
+    '#EXTM3U', '#EXTINF', '#EXT-X-VERSION', '#EXT-X-TARGETDURATION', '#EXT-X-MEDIA-SEQUENCE',
+    '#EXT-X-PLAYLIST-TYPE', '#EXT-X-ENDLIST', '#EXT-X-PROGRAM-DATE-TIME',
+    '#EXT-X-INDEPENDENT-SEGMENTS', '#EXT-X-ALLOW-CACHE',
+})
+# Informational tags Twitch adds to VOD playlists
+_CONCAT_SAFE_TAG_PREFIXES = ('#EXT-X-TWITCH-', '#ID3-EQUIV-')
+
+# One requests.Session per worker thread so segment downloads reuse keep-alive
+# connections instead of doing a fresh TCP+TLS handshake for every segment.
+_tls = threading.local()
+
+
+def _new_session(pool_size=DEFAULT_MAX_WORKERS):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _thread_session():
+    session = getattr(_tls, 's', None)
+    if session is None:
+        session = _tls.s = _new_session()
+    return session
 
 
 def download_json(url, headers=None, data=None):
-    response = requests.post(url, headers=headers, json=data)
+    response = _thread_session().post(url, headers=headers, json=data)
     response.raise_for_status()
     return response.json()
 
@@ -39,7 +85,9 @@ def get_video_id(url):
     raise ValueError("Invalid Twitch VOD URL")
 
 
-def download_video_metadata(video_id):
+def download_video_info(video_id):
+    # Metadata and the playback access token are independent, so ask for both
+    # in one GraphQL request instead of paying two round-trips.
     query = {
         "query": """
         {
@@ -56,28 +104,16 @@ def download_video_metadata(video_id):
             viewCount
             thumbnailURLs(height: 480, width: 640)
           }
-        }
-        """ % video_id,
-    }
-    headers = {'Client-ID': CLIENT_ID}
-    data = download_json(GQL_URL, headers=headers, data=query)
-    return data['data']['video']
-
-
-def get_access_token(video_id):
-    query = {
-        "query": """
-        {
           videoPlaybackAccessToken(id: "%s", params: {platform: "web", playerBackend: "mediaplayer", playerType: "site"}) {
             value
             signature
           }
         }
-        """ % video_id,
+        """ % (video_id, video_id),
     }
     headers = {'Client-ID': CLIENT_ID}
     data = download_json(GQL_URL, headers=headers, data=query)
-    return data['data']['videoPlaybackAccessToken']
+    return data['data']['video'], data['data']['videoPlaybackAccessToken']
 
 
 def get_m3u8_url(video_id, token, signature):
@@ -103,7 +139,8 @@ def is_master_playlist(playlist_text):
 
 
 def choose_variant_from_master(master_text, base_url):
-    # Parse master playlist, choose variant with highest BANDWIDTH
+    # Parse master playlist, choose variant with highest BANDWIDTH.
+    # Returns (uri, bandwidth in bits/s or None if not advertised).
     lines = master_text.splitlines()
     best_bandwidth = -1
     best_uri = None
@@ -120,51 +157,118 @@ def choose_variant_from_master(master_text, base_url):
                 if bw > best_bandwidth:
                     best_bandwidth = bw
                     best_uri = urllib.parse.urljoin(base_url, uri)
-    return best_uri
+    return best_uri, (best_bandwidth if best_bandwidth > 0 else None)
+
+
+def resolve_uri(base_dir, uri, query_suffix):
+    """
+    Resolves a playlist URI against base_dir (a query-less directory URL) and appends
+    query_suffix ("?<token query>" or "") when the resolved URL has no query of its own.
+    """
+    # Fast path: plain relative names like "123.ts" (the common HLS case) need no urljoin.
+    if uri and not _NEEDS_URLJOIN_RE.search(uri):
+        return base_dir + uri + query_suffix
+    abs_uri = urllib.parse.urljoin(base_dir, uri)
+    if query_suffix and not urllib.parse.urlparse(abs_uri).query:
+        sep = '&' if abs_uri.find('?') != -1 else '?'
+        abs_uri = abs_uri + sep + query_suffix[1:]
+    return abs_uri
 
 
 def fetch_text(url):
-    resp = requests.get(url, timeout=15)
+    resp = _thread_session().get(url, timeout=15)
     resp.raise_for_status()
     return resp.text
 
 
-def parse_key_attrs(line):
-    # Parse EXT-X-KEY attributes like METHOD=AES-128,URI="https://...",IV=0x...
-    attrs = {}
-    # Remove prefix
-    _, rest = line.split(':', 1)
-    parts = re.split(r',(?=(?:[^"]*"[^"]*")*[^"]*$)', rest)
-    for p in parts:
-        if '=' in p:
-            k, v = p.split('=', 1)
-            attrs[k.strip()] = v.strip().strip('"')
-    return attrs
+def _preallocate(f, size):
+    # Reserve the file's extents up front so the filesystem doesn't grow it block by block.
+    if not size or not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(f.fileno(), 0, int(size))
+    except (OSError, ValueError):
+        pass
+
+
+def download_file(session, url, path, timeout=SEGMENT_DOWNLOAD_TIMEOUT, retries=SEGMENT_DOWNLOAD_RETRIES,
+                  size_hint=None):
+    last_exc = None
+    for attempt in range(1, retries + 1):
+        try:
+            with session.get(url, headers=SEGMENT_HEADERS, stream=True, timeout=timeout) as r:
+                r.raise_for_status()
+                # A buffer as large as the copy chunk coalesces short reads from the
+                # socket into ~1 MiB writes instead of one write syscall per read.
+                with open(path, 'wb', buffering=COPY_BUFFER_SIZE) as f:
+                    # Content-Length is exact; otherwise fall back to the caller's estimate
+                    _preallocate(f, r.headers.get('Content-Length') or size_hint)
+                    r.raw.decode_content = True
+                    shutil.copyfileobj(r.raw, f, length=COPY_BUFFER_SIZE)
+                    # drop any preallocated tail if the body was shorter than advertised
+                    f.truncate(f.tell())
+            return
+        except Exception as e:
+            last_exc = e
+    raise last_exc
+
+
+def fetch_key(session, url, timeout=SEGMENT_DOWNLOAD_TIMEOUT, retries=SEGMENT_DOWNLOAD_RETRIES):
+    last_exc = None
+    for attempt in range(1, retries + 1):
+        try:
+            resp = session.get(url, timeout=timeout)
+            resp.raise_for_status()
+            return resp.content
+        except Exception as e:
+            last_exc = e
+    raise last_exc
 
 
-def download_file(url, path, timeout=SEGMENT_DOWNLOAD_TIMEOUT, retries=SEGMENT_DOWNLOAD_RETRIES):
-  last_exc = None
-  for attempt in range(1, retries + 1):
+def download_segments_with_aria2(aria2c, segment_infos, tmp_dir):
+    """
+    Downloads all segments with an external aria2c process instead of Python threads.
+
+    Returns:
+        True if aria2c exited successfully, False otherwise.
+    """
+    input_path = os.path.join(tmp_dir, "aria2.in")
+    with open(input_path, 'w', encoding='utf-8') as f:
+        for _, abs_url, local_name, *_ in segment_infos:
+            f.write(f"{abs_url}\n\tdir={tmp_dir}\n\tout={local_name}\n")
+    cmd = [
+        aria2c,
+        '-j', str(ARIA2_MAX_CONCURRENT),
+        '-x', str(ARIA2_MAX_CONNECTIONS_PER_SERVER),
+        '-s', str(ARIA2_MAX_CONNECTIONS_PER_SERVER),
+        '--timeout', str(SEGMENT_DOWNLOAD_TIMEOUT),
+        '--max-tries', str(SEGMENT_DOWNLOAD_RETRIES),
+        '--auto-file-renaming=false',
+        '--allow-overwrite=true',
+        '--console-log-level=warn',
+        # Drop the 60s summary block and the end-of-run result table. The live one-line
+        # console readout (--show-console-readout, on by default) is kept on purpose: it
+        # is the only progress display while aria2c runs, since no tqdm bar is shown then.
+        '--summary-interval=0',
+        '--download-result=hide',
+        '-i', input_path,
+    ]
     try:
-      with requests.get(url, stream=True, timeout=timeout) as r:
-        r.raise_for_status()
-        with open(path, 'wb') as f:
-          for chunk in r.iter_content(chunk_size=8192):
-            if chunk:
-              f.write(chunk)
-        return
-    except Exception as e:
-      last_exc = e
-      raise last_exc
+        result = subprocess.run(cmd)
+    except OSError:
+        return False
+    return result.returncode == 0
 
 
 def prepare_local_playlist_and_files(m3u8_url, tmp_dir, max_workers=DEFAULT_MAX_WORKERS):
     """
     Downloads the media playlist at m3u8_url, downloads keys and segments into tmp_dir,
-    writes a local playlist in tmp_dir/local.m3u8 and returns its path.
+    and writes the ffmpeg input for them: a concat demuxer list in tmp_dir/concat.txt for
+    plain TS playlists, or a rewritten playlist in tmp_dir/local.m3u8 when segments are
+    encrypted or need an init section.
 
     Returns:
-        local_m3u8_path (str)
+        (input_path, input_format) where input_format is 'concat' or 'hls'
     Raises:
         Exception on unrecoverable errors.
     """
@@ -181,10 +285,12 @@ def prepare_local_playlist_and_files(m3u8_url, tmp_dir, max_workers=DEFAULT_MAX_
         (parsed_m3u8.scheme, parsed_m3u8.netloc, os.path.dirname(parsed_m3u8.path) + '/', '', '', '')
     )
 
+    bandwidth = None  # bits/s of the chosen variant, used to estimate segment sizes
+
     # If this is a master playlist, pick the best variant and fetch it.
     if is_master_playlist(playlist_text):
         # logging suppressed for master playlist selection
-        variant_uri = choose_variant_from_master(playlist_text, base_dir)
+        variant_uri, bandwidth = choose_variant_from_master(playlist_text, base_dir)
         if not variant_uri:
             raise RuntimeError("Could not select a variant from master playlist")
         # Resolve variant_uri relative to the original m3u8_url base to handle relative URIs.
@@ -201,113 +307,164 @@ def prepare_local_playlist_and_files(m3u8_url, tmp_dir, max_workers=DEFAULT_MAX_
         # Keep the query we will want to propagate (variant may include query)
         original_query = parsed.query
 
-    lines = playlist_text.splitlines()
+    query_suffix = '?' + original_query if original_query else ''
     local_lines = []
-    segment_infos = []  # list of (index, abs_url, local_filename, local_path)
+    segment_infos = []  # list of (index, abs_url, local_filename, local_path, est_bytes)
     key_local_map = {}  # original abs_key_uri -> local_key_path
+    # AES keys rotate rarely, so one key URI covers many segments: each distinct key is
+    # fetched once per call and its bytes are kept as the future's result.
+    key_futures = {}  # original abs_key_uri -> Future of the key bytes
     segment_index = 0
+    est_bytes = None  # size estimate from the preceding #EXTINF, if any
+    concat_ok = True  # False once a tag or segment needs ffmpeg's HLS demuxer
 
-    i = 0
-    while i < len(lines):
-        line = lines[i].strip()
-        if line.startswith('#EXT-X-KEY'):
-            attrs = parse_key_attrs(line)
-            if 'URI' in attrs:
-                key_uri = attrs['URI']
-                # Resolve key URI relative to the variant/playlist
-                abs_key_uri = urllib.parse.urljoin(base_dir, key_uri)
-                parsed_key = urllib.parse.urlparse(abs_key_uri)
-                if not parsed_key.query and original_query:
-                    sep = '&' if abs_key_uri.find('?') != -1 else '?'
-                    abs_key_uri = abs_key_uri + sep + original_query
-                local_key_name = f"key_{len(key_local_map)}"
-                local_key_path = os.path.join(tmp_dir, local_key_name)
-                key_local_map[abs_key_uri] = local_key_path
-                # rewrite the key line to point to the local file (URI="<local>")
-                new_attrs = []
-                for k, v in attrs.items():
-                    if k == 'URI':
-                        new_attrs.append(f'URI="{os.path.basename(local_key_path)}"')
-                    else:
-                        new_attrs.append(f'{k}={v}')
-                local_lines.append('#EXT-X-KEY:' + ','.join(new_attrs))
-            else:
-                local_lines.append(line)
-            i += 1
-            continue
-
-        if line == '' or line.startswith('#'):
-            local_lines.append(line)
-            i += 1
-            continue
-
-        # Non-comment line: likely a segment URI
-        seg_uri = line
-        abs_seg_uri = urllib.parse.urljoin(base_dir, seg_uri)
-        parsed_seg = urllib.parse.urlparse(abs_seg_uri)
-        # If the resolved segment URL does not include the query params but the original playlist had them,
-        # append the original query so token/sig are preserved.
-        if not parsed_seg.query and original_query:
-            sep = '&' if abs_seg_uri.find('?') != -1 else '?'
-            abs_seg_uri = abs_seg_uri + sep + original_query
-
-        ext = os.path.splitext(seg_uri)[1] or '.ts'
-        local_seg_name = f"segment_{segment_index:06d}{ext}"
-        local_seg_path = os.path.join(tmp_dir, local_seg_name)
-        segment_infos.append((segment_index, abs_seg_uri, local_seg_name, local_seg_path))
-        local_lines.append(local_seg_name)
-        segment_index += 1
-        i += 1
-
-    # Download keys first
-    for abs_key_uri, local_key_path in key_local_map.items():
-        # logging suppressed for key downloads
-        try:
-            download_file(abs_key_uri, local_key_path)
-        except Exception as e:
-            raise RuntimeError(f"Failed to download key {abs_key_uri}: {e}")
-
-    # Download segments in parallel (same as before)
-    # logging suppressed for segment download summary
     errors = []
-    lock = threading.Lock()
+    # Segments go to aria2c when it is installed; keys always use the Python pool.
+    aria2c = shutil.which('aria2c')
 
     def _dl_task(info):
-        idx, abs_url, local_name, local_path = info
+        idx, abs_url, local_name, local_path, est_bytes = info
         try:
-            download_file(abs_url, local_path)
+            download_file(_thread_session(), abs_url, local_path, size_hint=est_bytes)
             return (idx, None)
         except Exception as e:
             return (idx, e)
-    pbar = tqdm.tqdm(total=len(segment_infos))
-    with ThreadPoolExecutor(max_workers=max_workers) as ex:
-        futures = {ex.submit(_dl_task, si): si for si in segment_infos}
-        for fut in as_completed(futures):
-            idx, err = fut.result()
-            pbar.update(1)
-            if err:
-                with lock:
+
+    def _key_task(abs_key_uri, local_key_path):
+        data = fetch_key(_thread_session(), abs_key_uri)
+        with open(local_key_path, 'wb') as f:
+            f.write(data)
+        return data
+
+    # Downloads are submitted as the playlist is parsed, so keys and the first
+    # segments are already in flight while the rest of the manifest is processed.
+    ex = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {}
+    try:
+        for m in _LINE_RE.finditer(playlist_text):
+            if m.start() == len(playlist_text):
+                # '^' also matches after a trailing newline; that is not a line of its own
+                break
+            key_attrs = m.group('key')
+            if key_attrs is not None:
+                attrs = dict(_KEY_ATTR_RE.findall(key_attrs.rstrip()))
+                if 'URI' in attrs:
+                    key_uri = attrs['URI'].strip('"')
+                    # Resolve key URI relative to the variant/playlist
+                    abs_key_uri = resolve_uri(base_dir, key_uri, query_suffix)
+                    local_key_path = key_local_map.get(abs_key_uri)
+                    if local_key_path is None:
+                        local_key_name = f"key_{hashlib.sha1(abs_key_uri.encode()).hexdigest()[:16]}"
+                        local_key_path = os.path.join(tmp_dir, local_key_name)
+                        key_local_map[abs_key_uri] = local_key_path
+                        key_futures[abs_key_uri] = ex.submit(_key_task, abs_key_uri, local_key_path)
+                    # rewrite the key line to point to the local file (URI="<local>")
+                    new_attrs = []
+                    for k, v in attrs.items():
+                        if k == 'URI':
+                            new_attrs.append(f'URI="{os.path.basename(local_key_path)}"')
+                        else:
+                            new_attrs.append(f'{k}={v}')
+                    local_lines.append('#EXT-X-KEY:' + ','.join(new_attrs))
+                else:
+                    local_lines.append(m.group(0).strip())
+                continue
+
+            seg_uri = m.group('seg')
+            if seg_uri is None:
+                comment = m.group('comment').rstrip()
+                if bandwidth and comment.startswith('#EXTINF:'):
+                    try:
+                        duration = float(comment[8:].split(',', 1)[0])
+                        est_bytes = int(duration * bandwidth / 8)
+                    except ValueError:
+                        est_bytes = None
+                if concat_ok and comment.startswith('#EXT'):
+                    tag = comment.split(':', 1)[0]
+                    if tag not in _CONCAT_SAFE_TAGS and not tag.startswith(_CONCAT_SAFE_TAG_PREFIXES):
+                        # e.g. EXT-X-BYTERANGE, EXT-X-MAP, EXT-X-DISCONTINUITY
+                        concat_ok = False
+                local_lines.append(comment)
+                continue
+
+            # Non-comment line: likely a segment URI
+            seg_uri = seg_uri.rstrip()
+            # If the resolved segment URL does not include the query params but the original playlist had them,
+            # append the original query so token/sig are preserved.
+            abs_seg_uri = resolve_uri(base_dir, seg_uri, query_suffix)
+
+            ext = os.path.splitext(seg_uri)[1] or '.ts'
+            if ext != '.ts':
+                concat_ok = False
+            local_seg_name = f"segment_{segment_index:06d}{ext}"
+            local_seg_path = os.path.join(tmp_dir, local_seg_name)
+            info = (segment_index, abs_seg_uri, local_seg_name, local_seg_path, est_bytes)
+            segment_infos.append(info)
+            if not aria2c:
+                futures[ex.submit(_dl_task, info)] = info
+            local_lines.append(local_seg_name)
+            segment_index += 1
+            est_bytes = None
+
+        for abs_key_uri, fut in key_futures.items():
+            # logging suppressed for key downloads
+            try:
+                fut.result()
+            except Exception as e:
+                raise RuntimeError(f"Failed to download key {abs_key_uri}: {e}")
+
+        if aria2c and segment_infos:
+            if not download_segments_with_aria2(aria2c, segment_infos, tmp_dir):
+                # fall back to the threaded path, but only for segments aria2c did not finish:
+                # a missing file, or one still paired with an in-progress .aria2 control file
+                for info in segment_infos:
+                    local_path = info[3]
+                    if not os.path.exists(local_path) or os.path.exists(local_path + '.aria2'):
+                        futures[ex.submit(_dl_task, info)] = info
+
+        # logging suppressed for segment download summary
+        if futures:
+            pbar = tqdm.tqdm(total=len(futures))
+            # Update the bar in batches; a refresh per segment is a lock + flush on the main thread.
+            batch = 0
+            for fut in as_completed(futures):
+                idx, err = fut.result()
+                if err:
                     errors.append((idx, err))
-            else:
-                # progress printed via tqdm only
-                pass
-        pbar.close()
+                batch += 1
+                if batch >= PROGRESS_UPDATE_EVERY:
+                    pbar.update(batch)
+                    batch = 0
+            pbar.update(batch)
+            pbar.close()
+    finally:
+        # cancel_futures drops queued downloads if we bail out early (e.g. a key failed)
+        ex.shutdown(wait=True, cancel_futures=True)
     if errors:
         raise RuntimeError(f"{len(errors)} segments failed to download; first error: {errors[0][1]}")
 
+    # Unencrypted .ts segments with only basic tags are complete files that can be
+    # concatenated, which spares ffmpeg the HLS demuxer. Anything else (keys, byte
+    # ranges, init sections, other segment types) still needs the rewritten playlist.
+    if concat_ok and not key_local_map:
+        concat_path = os.path.join(tmp_dir, "concat.txt")
+        with open(concat_path, 'w', encoding='utf-8') as f:
+            for info in segment_infos:
+                f.write(f"file '{info[2]}'\n")
+        return concat_path, 'concat'
+
     # Write local playlist
     local_m3u8_path = os.path.join(tmp_dir, "local.m3u8")
     # logging suppressed for playlist writing
     with open(local_m3u8_path, 'w', encoding='utf-8') as f:
         f.write('\n'.join(local_lines))
         f.write('\n')
-    return local_m3u8_path
+    return local_m3u8_path, 'hls'
 
 def download_vod(id, output_dir, max_workers=DEFAULT_MAX_WORKERS) -> bool:
     url = f"www.twitch.tv/videos/{id}"
     video_id = get_video_id(url)
-    metadata = download_video_metadata(video_id)
-    access_token = get_access_token(video_id)
+    metadata, access_token = download_video_info(video_id)
 
     m3u8_url = get_m3u8_url(video_id, access_token['value'], access_token['signature'])
 
@@ -318,10 +475,13 @@ def download_vod(id, output_dir, max_workers=DEFAULT_MAX_WORKERS) -> bool:
     tmp_dir = tempfile.mkdtemp(prefix="twitch_vod_")
     try:
       try:
-        local_playlist = prepare_local_playlist_and_files(m3u8_url, tmp_dir, max_workers=max_workers)
+        input_path, input_format = prepare_local_playlist_and_files(m3u8_url, tmp_dir, max_workers=max_workers)
       except Exception:
         return False
-      ffmpeg.input(local_playlist).output(f"{output_dir}/{output_file}", c='copy', metadata=metadata).run()
+      input_opts = {'f': 'concat', 'safe': 0} if input_format == 'concat' else {}
+      ffmpeg.input(input_path, **input_opts).output(
+          f"{output_dir}/{output_file}", c='copy', metadata=metadata, **{'bsf:a': 'aac_adtstoasc'}
+      ).run()
     finally:
       # Remove temporary directory only when ffmpeg succeeded and output looks valid.
       try:
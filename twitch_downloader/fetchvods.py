@@ -5,6 +5,15 @@ from typing import Dict, List, Optional
 
 import requests
 
+try:
+  import orjson
+except ImportError:
+  # orjson is optional; the stdlib module has the same loads() interface
+  orjson = json
+
+# first characters of a JSON object/array; anything else is not worth a parse attempt
+_JSON_START = frozenset('{[')
+
 
 def get_vod_url(limit: int, offset: int) -> str:
   """
@@ -18,10 +27,10 @@ def _normalize_embedded_json(obj: dict) -> None:
   """
   Mutates obj in-place: if any value is a JSON-like string, attempt to parse it.
   """
-  for key, val in list(obj.items()):
-    if isinstance(val, str) and "{" in val:
+  for key, val in obj.items():
+    if isinstance(val, str) and val[:1] in _JSON_START:
       try:
-        obj[key] = json.loads(val)
+        obj[key] = orjson.loads(val)
       except Exception:
         # leave the original string if parsing fails
         pass
@@ -42,6 +51,9 @@ def _simplify_obj(obj: dict) -> dict:
   """
   # ensure any embedded json strings are parsed first
   _normalize_embedded_json(obj)
+  md = obj.get("match_data") or {}
+  info = md.get("info") or {}
+  metatft = md.get("_metatft") or {}
 
   # Twitch info
   twitch_account = obj.get("twitch_account_info") or {}
@@ -70,7 +82,7 @@ def _simplify_obj(obj: dict) -> dict:
     league["games_played"] = la.get("num_played")
   else:
     # fallback to match_data._metatft.participant_info (use first participant if present)
-    md_participants = obj.get("match_data", {}).get("_metatft", {}).get("participant_info")
+    md_participants = metatft.get("participant_info")
     if isinstance(md_participants, list) and len(md_participants) > 0:
       p = md_participants[0]
       league["riot_id"] = p.get("riot_id")
@@ -80,7 +92,7 @@ def _simplify_obj(obj: dict) -> dict:
       league["games_played"] = ranked.get("num_games")
 
   # Game version (try match_data.info.game_version)
-  game_version = obj.get("match_data", {}).get("info", {}).get("game_version")
+  game_version = info.get("game_version")
 
   return {
     "vod_data": {
@@ -102,13 +114,12 @@ def get_vods_list(limit: int, offset: int) -> List[Dict] | Optional[None]:
   # Fallback to remote API
   res = requests.get(get_vod_url(limit, offset))
   if res.status_code == 200:
-    objs = json.loads(res.text)
+    objs = orjson.loads(res.content)
     simplified = []
     if isinstance(objs, dict):
       objs = [objs]
     for obj in objs:
       if isinstance(obj, dict):
-        _normalize_embedded_json(obj)
         simplified.append(_simplify_obj(obj))
     return simplified
   else: